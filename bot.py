@@ -1,25 +1,49 @@
+import asyncio
 import base64
+import functools
 import html
 import json
 import os
 import logging
+import re
+import threading
 import time
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
 
 import firebase_admin
+from cachetools import TTLCache
+
+try:
+    import ahocorasick
+except ImportError:  # optional speedup; substring matching falls back to regex
+    ahocorasick = None
+
+try:
+    import uvloop
+except ImportError:  # optional speedup; the stock event loop works fine
+    uvloop = None
 from firebase_admin import credentials, db
 from telegram import ChatPermissions, Update
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    SimpleUpdateProcessor,
     filters,
 )
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    # Explicit datefmt skips the default msec formatting pass per record.
+    datefmt="%Y-%m-%dT%H:%M:%S",
+)
+LOGGER = logging.getLogger(__name__)
 
 # Firebase init
 
@@ -95,23 +119,63 @@ firebase_admin.initialize_app(cred, {"databaseURL": firebase_db_url})
 ADMINS_REF = db.reference("admins")
 GROUPS_REF = db.reference("groups")
 USERS_REF = db.reference("users")
+USERNAME_INDEX_REF = db.reference("username_index")
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN environment variable is required")
 
-# In-memory flood tracking
-user_message_times = defaultdict(list)
+# In-memory flood tracking. Per-user timestamp deques in a TTL cache slightly
+# wider than the flood window, so idle users expire on their own and the
+# tracker stays bounded on long-running bots.
+FLOOD_WINDOW = 10.0
+user_message_times: TTLCache = TTLCache(maxsize=100_000, ttl=15)
+
+# Cached group settings. One full group fetch per chat every TTL window instead
+# of several .child(...).get() round-trips on every message. The streaming
+# listener below invalidates entries from a background thread, so every access
+# goes through the lock.
+GROUP_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=30)
+_GROUP_CACHE_LOCK = threading.Lock()
 
 # Helper functions
 FIREBASE_INVALID_KEY_CHARS = (".", "#", "$", "[", "]", "/")
+_SANITIZE_TABLE = str.maketrans({char: "_" for char in FIREBASE_INVALID_KEY_CHARS})
 
 
 def sanitize_key(key: str) -> str:
-    sanitized = key
-    for char in FIREBASE_INVALID_KEY_CHARS:
-        sanitized = sanitized.replace(char, "_")
-    return sanitized
+    return key.translate(_SANITIZE_TABLE)
+
+
+# Thin async wrappers so blocking Firebase calls run in worker threads instead
+# of stalling the event loop while other updates wait. A dedicated bounded pool
+# keeps burst load from spawning threads without limit.
+_FB_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="firebase")
+
+
+async def _run_fb(fn, *args) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_FB_EXECUTOR, fn, *args)
+
+
+async def fb_get(ref) -> Any:
+    return await _run_fb(ref.get)
+
+
+async def fb_set(ref, value: Any) -> None:
+    await _run_fb(ref.set, value)
+
+
+async def fb_update(ref, value: Dict[str, Any]) -> None:
+    await _run_fb(ref.update, value)
+
+
+async def fb_delete(ref) -> None:
+    await _run_fb(ref.delete)
+
+
+async def fb_batch_update(paths: Dict[str, Any]) -> None:
+    """Write several paths atomically in one round-trip; None deletes a path."""
+    await _run_fb(db.reference("/").update, paths)
 
 
 def ensure_list(raw: Any) -> List[str]:
@@ -120,8 +184,9 @@ def ensure_list(raw: Any) -> List[str]:
     if isinstance(raw, list):
         return [entry for entry in raw if isinstance(entry, str)]
     if isinstance(raw, dict):
-        ordered_keys = sorted(raw.keys())
-        return [raw[key] for key in ordered_keys if isinstance(raw[key], str)]
+        # Push ids are lexically time-ordered and Firebase returns them in key
+        # order, so insertion order is already chronological — no sort needed.
+        return [value for value in raw.values() if isinstance(value, str)]
     return []
 
 
@@ -136,44 +201,375 @@ def normalize_filters(raw: Any) -> Dict[str, Dict[str, str]]:
             if trigger and reply is not None:
                 result[str(key)] = {
                     "trigger": str(trigger),
+                    "trigger_lc": str(value.get("trigger_lc") or trigger).lower(),
                     "reply": str(reply),
                 }
         elif isinstance(value, str):
-            result[str(key)] = {"trigger": str(key), "reply": value}
+            result[str(key)] = {
+                "trigger": str(key),
+                "trigger_lc": str(key).lower(),
+                "reply": value,
+            }
     return result
 
 
-def get_filters(chat_id: int) -> Dict[str, Dict[str, str]]:
-    return normalize_filters(group_ref(chat_id).child("filters").get())
+async def get_group_settings(chat_id: int) -> Dict[str, Any]:
+    with _GROUP_CACHE_LOCK:
+        settings = GROUP_CACHE.get(chat_id)
+    if settings is None:
+        settings = await fb_get(group_ref(chat_id)) or {}
+        with _GROUP_CACHE_LOCK:
+            GROUP_CACHE[chat_id] = settings
+    return settings
+
+
+def invalidate_group_cache(chat_id: int) -> None:
+    with _GROUP_CACHE_LOCK:
+        GROUP_CACHE.pop(chat_id, None)
+
+
+def update_cached_settings(chat_id: int, path: str, value: Any) -> None:
+    """Mirror a local write into the cached snapshot instead of dropping it.
+
+    ``path`` is a slash-separated child path under the group node; ``value`` of
+    None deletes the leaf, matching Firebase update semantics.
+    """
+    with _GROUP_CACHE_LOCK:
+        settings = GROUP_CACHE.get(chat_id)
+        if settings is None:
+            return
+        *parents, leaf = path.split("/")
+        node = settings
+        for part in parents:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = {}
+                node[part] = child
+            node = child
+        if value is None:
+            node.pop(leaf, None)
+        else:
+            node[leaf] = value
+        GROUP_CACHE[chat_id] = settings
+
 
+# Listener registrations are kept so shutdown can close their non-daemon
+# threads; otherwise the process never exits after run_polling returns.
+_GROUP_LISTENER = None
 
-def update_name_history(user) -> None:
+
+def _on_groups_event(event) -> None:
+    """Drop cached settings for chats touched by out-of-band writes."""
+    if event.path == "/":
+        with _GROUP_CACHE_LOCK:
+            GROUP_CACHE.clear()
+        return
+    key = event.path.lstrip("/").split("/", 1)[0]
+    if key.lstrip("-").isdigit():
+        invalidate_group_cache(int(key))
+
+
+def start_group_listener() -> None:
+    global _GROUP_LISTENER
+    try:
+        _GROUP_LISTENER = GROUPS_REF.listen(_on_groups_event)
+    except Exception:
+        LOGGER.warning(
+            "Group streaming listener unavailable; relying on the cache TTL",
+            exc_info=True,
+        )
+
+
+async def get_filters(chat_id: int) -> Dict[str, Dict[str, str]]:
+    return normalize_filters((await get_group_settings(chat_id)).get("filters"))
+
+
+# Compiled filter matchers per chat, keyed by a fingerprint of the filter set
+# so edits rebuild the matcher automatically.
+_FILTER_MATCHERS: Dict[int, Tuple[Tuple[Tuple[str, str], ...], Any]] = {}
+
+
+def _build_filter_matcher(entries: Tuple[Tuple[str, str], ...]):
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for trigger_lc, reply in entries:
+            automaton.add_word(trigger_lc, reply)
+        automaton.make_automaton()
+
+        def match(lowered: str):
+            for _, reply in automaton.iter(lowered):
+                return reply
+            return None
+
+        return match
+
+    pattern = re.compile("|".join(re.escape(trigger_lc) for trigger_lc, _ in entries))
+    replies = dict(entries)
+
+    def match(lowered: str):
+        found = pattern.search(lowered)
+        return replies.get(found.group(0)) if found else None
+
+    return match
+
+
+def filter_matcher_from_settings(chat_id: int, settings: Dict[str, Any]):
+    filters_data = normalize_filters(settings.get("filters"))
+    entries = tuple(
+        sorted(
+            (data["trigger_lc"], data["reply"])
+            for data in filters_data.values()
+            if data.get("trigger_lc") and data.get("reply")
+        )
+    )
+    if not entries:
+        _FILTER_MATCHERS.pop(chat_id, None)
+        return None
+    cached = _FILTER_MATCHERS.get(chat_id)
+    if cached is not None and cached[0] == entries:
+        return cached[1]
+    matcher = _build_filter_matcher(entries)
+    _FILTER_MATCHERS[chat_id] = (entries, matcher)
+    return matcher
+
+
+# Last recorded display name per user, so unchanged names (the common case)
+# skip Firebase entirely on the per-message path. LRU-bounded so the memo
+# cannot grow with the all-time user count.
+# The hour TTL re-seeds a user from Firebase occasionally, so a rename recorded
+# by another instance cannot be shadowed by this one's memo forever.
+LAST_NAME_CACHE: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+
+# Last indexed username per user, so a rename drops its stale index entry.
+LAST_USERNAME_CACHE: TTLCache = TTLCache(maxsize=100_000, ttl=3600)
+
+
+async def update_name_history(user) -> None:
     if user is None:
         return
-    history_ref = user_ref(user.id).child("history")
-    history = ensure_list(history_ref.get())
     new_name = f"{user.first_name or ''} {user.last_name or ''} (@{user.username or 'no_username'})".strip()
-    if not history or history[-1] != new_name:
-        history.append(new_name)
-        history_ref.set(history)
+    if LAST_NAME_CACHE.get(user.id) == new_name:
+        return
+    history_ref = user_ref(user.id).child("history")
+    if user.id not in LAST_NAME_CACHE:
+        # First sighting this process: seed the cache from the newest stored
+        # entry so restarts do not duplicate it.
+        stored = ensure_list(await fb_get(history_ref.order_by_key().limit_to_last(1)))
+        if stored and stored[-1] == new_name:
+            LAST_NAME_CACHE[user.id] = new_name
+            return
+    paths: Dict[str, Any] = {f"users/{user.id}/history/{_history_key()}": new_name}
+    LAST_NAME_CACHE[user.id] = new_name
+
+    username_lower = (user.username or "").lower()
+    if username_lower:
+        paths[f"username_index/{sanitize_key(username_lower)}"] = user.id
+    old_username = LAST_USERNAME_CACHE.get(user.id)
+    if old_username and old_username != username_lower:
+        paths[f"username_index/{sanitize_key(old_username)}"] = None
+    LAST_USERNAME_CACHE[user.id] = username_lower
+    NAME_WRITE_QUEUE.put_nowait(paths)
+
+
+def _history_key() -> str:
+    # Nanosecond timestamps are lexically ordered at fixed width and sort
+    # after legacy push ids (which start with '-'), keeping history
+    # chronological without a round-trip to generate the key.
+    return str(time.time_ns())
+
+
+# Rename writes are coalesced by a background flusher: each queue item is a
+# multi-path dict, and one root update per window commits every pending
+# history append and index change in a single round-trip.
+NAME_WRITE_QUEUE: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+NAME_FLUSH_MAX = 50
+NAME_FLUSH_WINDOW = 1.0
+
+
+async def _name_write_flusher() -> None:
+    while True:
+        paths = await NAME_WRITE_QUEUE.get()
+        deadline = time.monotonic() + NAME_FLUSH_WINDOW
+        while len(paths) < NAME_FLUSH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                paths.update(await asyncio.wait_for(NAME_WRITE_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await fb_batch_update(paths)
+        except Exception:
+            LOGGER.warning(
+                "Failed to flush %d name-history writes", len(paths), exc_info=True
+            )
+
+
+# Log events are queued and flushed by a background worker so handlers never
+# wait on the log channel send; consecutive events per chat are batched into
+# one Telegram message.
+LOG_QUEUE: "asyncio.Queue[Tuple[int, str]]" = asyncio.Queue()
+LOG_BATCH_MAX = 10
+LOG_MESSAGE_MAX = 4096
+LOG_BATCH_WINDOW = 0.25
 
 
 async def send_log(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str) -> None:
-    log_chat_id = group_ref(chat_id).child("log_channel").get()
-    if not log_chat_id:
-        return
-    try:
-        target_chat = int(str(log_chat_id))
-    except (TypeError, ValueError):
-        target_chat = log_chat_id
+    del context  # kept for call-site compatibility; sending happens in _log_worker
+    LOG_QUEUE.put_nowait((chat_id, text))
+
+
+def _chunk_log_texts(texts: List[str]) -> List[str]:
+    """Join entries with blank lines, splitting at Telegram's 4096-char cap."""
+    chunks: List[str] = []
+    current = ""
+    for text in texts:
+        candidate = f"{current}\n\n{text}" if current else text
+        if len(candidate) > LOG_MESSAGE_MAX and current:
+            chunks.append(current)
+            candidate = text
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+async def _log_worker(application) -> None:
+    while True:
+        batches: Dict[int, List[str]] = {}
+        chat_id, text = await LOG_QUEUE.get()
+        batches.setdefault(chat_id, []).append(text)
+        deadline = time.monotonic() + LOG_BATCH_WINDOW
+        while sum(len(texts) for texts in batches.values()) < LOG_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                chat_id, text = await asyncio.wait_for(LOG_QUEUE.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            batches.setdefault(chat_id, []).append(text)
+        for chat_id, texts in batches.items():
+            try:
+                log_chat_id = (await get_group_settings(chat_id)).get("log_channel")
+            except Exception:
+                LOGGER.warning(
+                    "Failed to resolve log channel for chat %s", chat_id, exc_info=True
+                )
+                continue
+            if not log_chat_id:
+                continue
+            try:
+                target_chat = int(str(log_chat_id))
+            except (TypeError, ValueError):
+                target_chat = log_chat_id
+            for chunk in _chunk_log_texts(texts):
+                try:
+                    await application.bot.send_message(
+                        chat_id=target_chat, text=chunk, parse_mode="HTML"
+                    )
+                except Exception:
+                    LOGGER.warning(
+                        "Failed to send log batch for chat %s", chat_id, exc_info=True
+                    )
+
+
+async def _expire_flood_tracker(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sweep expired flood entries; TTLCache only evicts them opportunistically."""
+    del context  # unused
+    user_message_times.expire()
+
+
+async def _on_startup(application) -> None:
+    application.create_task(_log_worker(application))
+    application.create_task(_name_write_flusher())
+
+
+async def _on_shutdown(application) -> None:
+    del application  # unused
+    for registration in (_ADMIN_LISTENER, _GROUP_LISTENER):
+        if registration is None:
+            continue
+        try:
+            registration.close()
+        except Exception:
+            LOGGER.debug("Failed to close Firebase listener", exc_info=True)
+
+
+# Cached admin checks. Admins change rarely, so a short TTL saves one Firebase
+# round-trip per admin-gated command.
+ADMIN_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=60)
+
+# Live mirror of the admins node, fed by a streaming listener so is_admin is a
+# set lookup once the stream is up. The firebase_admin SDK runs the callback on
+# a background thread; a frozenset reassignment is atomic under the GIL, so
+# readers on the event loop always see a consistent set.
+_ADMINS_MIRROR: Dict[str, Any] = {}
+_ADMIN_IDS: Optional[FrozenSet[int]] = None
+
+
+def _rebuild_admin_ids() -> None:
+    global _ADMIN_IDS
+    _ADMIN_IDS = frozenset(
+        int(key)
+        for key, value in _ADMINS_MIRROR.items()
+        if value is True and key.lstrip("-").isdigit()
+    )
+
+
+def _on_admins_event(event) -> None:
+    global _ADMINS_MIRROR
+    if event.path == "/":
+        if event.event_type == "patch":
+            # A patch carries only the changed children; merge it instead of
+            # replacing the mirror, or every other admin would vanish.
+            changes = event.data if isinstance(event.data, dict) else {}
+            for key, value in changes.items():
+                if value is None:
+                    _ADMINS_MIRROR.pop(key, None)
+                else:
+                    _ADMINS_MIRROR[key] = value
+        else:
+            _ADMINS_MIRROR = dict(event.data) if isinstance(event.data, dict) else {}
+    else:
+        key = event.path.lstrip("/").split("/", 1)[0]
+        if event.data is None:
+            _ADMINS_MIRROR.pop(key, None)
+        else:
+            _ADMINS_MIRROR[key] = event.data
+    _rebuild_admin_ids()
+
+
+_ADMIN_LISTENER = None
+
+
+def start_admin_listener() -> None:
+    global _ADMIN_LISTENER
     try:
-        await context.bot.send_message(chat_id=target_chat, text=text, parse_mode="HTML")
+        _ADMIN_LISTENER = ADMINS_REF.listen(_on_admins_event)
     except Exception:
-        logging.warning("Failed to send log message for chat %s", chat_id, exc_info=True)
+        LOGGER.warning(
+            "Admin streaming listener unavailable; falling back to cached reads",
+            exc_info=True,
+        )
+
 
+async def is_admin(user_id: int) -> bool:
+    if _ADMIN_IDS is not None:
+        return user_id in _ADMIN_IDS
+    cached = ADMIN_CACHE.get(user_id)
+    if cached is None:
+        cached = await fb_get(ADMINS_REF.child(str(user_id))) is True
+        ADMIN_CACHE[user_id] = cached
+    return cached
 
-def is_admin(user_id: int) -> bool:
-    return ADMINS_REF.child(str(user_id)).get() is True
+
+def invalidate_admin_cache(user_id: int = None) -> None:
+    if user_id is None:
+        ADMIN_CACHE.clear()
+    else:
+        ADMIN_CACHE.pop(user_id, None)
 
 def group_ref(chat_id: int):
     return GROUPS_REF.child(str(chat_id))
@@ -181,23 +577,80 @@ def group_ref(chat_id: int):
 def user_ref(user_id: int):
     return USERS_REF.child(str(user_id))
 
-def is_banned(chat_id: int, user_id: int) -> bool:
-    return group_ref(chat_id).child("blacklist").child(str(user_id)).get() is True
+def is_banned(settings: Dict[str, Any], user_id: int) -> bool:
+    blacklist = settings.get("blacklist") or {}
+    return blacklist.get(str(user_id)) is True
+
+_NAME_VAR_RE = re.compile(r"\{(first|last|username)\}")
+
+
+def _name_var(name: str, user) -> str:
+    if name == "first":
+        return user.first_name or ""
+    if name == "last":
+        return user.last_name or ""
+    return f"@{user.username}" if user.username else ""
+
+
+@functools.lru_cache(maxsize=1024)
+def _template_segments(text: str) -> Tuple[str, ...]:
+    # re.split with one capture group interleaves literals and variable names:
+    # odd indexes are the captured {first|last|username} names.
+    return tuple(_NAME_VAR_RE.split(text))
+
 
 def format_name_vars(text, user):
-    return text.replace("{first}", user.first_name or "") \
-               .replace("{last}", user.last_name or "") \
-               .replace("{username}", f"@{user.username}" if user.username else "")
+    segments = _template_segments(text)
+    if len(segments) == 1:
+        return text
+    return "".join(
+        _name_var(segment, user) if index % 2 else segment
+        for index, segment in enumerate(segments)
+    )
+
+
+def admin_command(usage: str = None, min_args: int = 1):
+    """Gate a handler behind the cached admin check and an optional args check."""
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if not await is_admin(update.effective_user.id):
+                await update.message.reply_text("🚫 Only admins can use this command.")
+                return
+            if usage is not None and len(context.args) < min_args:
+                await update.message.reply_text(f"Usage: {usage}")
+                return
+            return await handler(update, context)
+
+        return wrapper
+
+    return decorator
+
+
+def require_reply(action: str):
+    """Gate a moderation handler behind a reply target and the cached admin check."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if not update.message.reply_to_message:
+                await update.message.reply_text(f"Reply to a user to /{action} them.")
+                return
+            if not await is_admin(update.effective_user.id):
+                await update.message.reply_text("🚫 Only admins can use this command.")
+                return
+            return await handler(update, context)
+
+        return wrapper
+
+    return decorator
+
 
 # -----------------------
 # Command Handlers
 # -----------------------
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("✅ BreakTheICX Bot is active!")
-
-async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = """
+HELP_TEXT = """
 📌 General Commands
 /start → Activate bot
 /help → Show this message
@@ -229,7 +682,13 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /history → Your past names
 /history @username → Specific user history
 """
-    await update.message.reply_text(text)
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("✅ BreakTheICX Bot is active!")
+
+async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(HELP_TEXT)
 
 async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🤖 BreakTheICX Bot v1.0 — Group moderation & spam protection!")
@@ -237,15 +696,11 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 # Group Management
 # -----------------------
+@admin_command(usage="/setwelcome <text>")
 async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can set welcome message.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /setwelcome <text>")
-        return
     text = " ".join(context.args).strip()
-    group_ref(update.effective_chat.id).update({"welcome_text": text})
+    await fb_update(group_ref(update.effective_chat.id), {"welcome_text": text})
+    update_cached_settings(update.effective_chat.id, "welcome_text", text)
     await update.message.reply_text(f"✅ Welcome message set to:\n{text}")
     await send_log(
         context,
@@ -253,15 +708,11 @@ async def set_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📝 Welcome message updated by {update.effective_user.mention_html()}: {html.escape(text)}",
     )
 
+@admin_command(usage="/setgoodbye <text>")
 async def set_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can set goodbye message.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /setgoodbye <text>")
-        return
     text = " ".join(context.args).strip()
-    group_ref(update.effective_chat.id).update({"goodbye_text": text})
+    await fb_update(group_ref(update.effective_chat.id), {"goodbye_text": text})
+    update_cached_settings(update.effective_chat.id, "goodbye_text", text)
     await update.message.reply_text(f"✅ Goodbye message set to:\n{text}")
     await send_log(
         context,
@@ -269,15 +720,11 @@ async def set_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📤 Goodbye message updated by {update.effective_user.mention_html()}: {html.escape(text)}",
     )
 
+@admin_command(usage="/welcome on|off")
 async def toggle_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can toggle welcome.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /welcome on|off")
-        return
     status = context.args[0].lower() == "on"
-    group_ref(update.effective_chat.id).update({"welcome_on": status})
+    await fb_update(group_ref(update.effective_chat.id), {"welcome_on": status})
+    update_cached_settings(update.effective_chat.id, "welcome_on", status)
     await update.message.reply_text(
         f"✅ Welcome messages {'enabled' if status else 'disabled'}."
     )
@@ -287,15 +734,11 @@ async def toggle_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🔔 Welcome messages {'enabled' if status else 'disabled'} by {update.effective_user.mention_html()}.",
     )
 
+@admin_command(usage="/goodbye on|off")
 async def toggle_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can toggle goodbye.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /goodbye on|off")
-        return
     status = context.args[0].lower() == "on"
-    group_ref(update.effective_chat.id).update({"goodbye_on": status})
+    await fb_update(group_ref(update.effective_chat.id), {"goodbye_on": status})
+    update_cached_settings(update.effective_chat.id, "goodbye_on", status)
     await update.message.reply_text(
         f"✅ Goodbye messages {'enabled' if status else 'disabled'}."
     )
@@ -308,13 +751,8 @@ async def toggle_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 # Filters, Flood & Logging
 # -----------------------
+@admin_command(usage="/setflood <number>")
 async def set_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can set flood limit.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /setflood <number>")
-        return
     try:
         limit = int(context.args[0])
     except ValueError:
@@ -323,7 +761,8 @@ async def set_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if limit < 1:
         await update.message.reply_text("Flood limit must be at least 1.")
         return
-    group_ref(update.effective_chat.id).update({"flood_limit": limit})
+    await fb_update(group_ref(update.effective_chat.id), {"flood_limit": limit})
+    update_cached_settings(update.effective_chat.id, "flood_limit", limit)
     await update.message.reply_text(f"✅ Flood limit set to {limit} messages per 10 seconds.")
     await send_log(
         context,
@@ -332,22 +771,17 @@ async def set_flood(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@admin_command(usage="/addfilter <word> <reply>", min_args=2)
 async def add_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can add filters.")
-        return
-    if len(context.args) < 2:
-        await update.message.reply_text("Usage: /addfilter <word> <reply>")
-        return
     trigger = context.args[0]
     reply_text = " ".join(context.args[1:]).strip()
     if not reply_text:
         await update.message.reply_text("Reply text cannot be empty.")
         return
     key = sanitize_key(trigger.lower())
-    filters_data = get_filters(update.effective_chat.id)
-    filters_data[key] = {"trigger": trigger, "reply": reply_text}
-    group_ref(update.effective_chat.id).child("filters").set(filters_data)
+    entry = {"trigger": trigger, "trigger_lc": trigger.lower(), "reply": reply_text}
+    await fb_set(group_ref(update.effective_chat.id).child("filters").child(key), entry)
+    update_cached_settings(update.effective_chat.id, f"filters/{key}", entry)
     await update.message.reply_text(f"✅ Filter added for '{trigger}'.")
     await send_log(
         context,
@@ -356,21 +790,16 @@ async def add_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@admin_command(usage="/delfilter <word>")
 async def delete_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can delete filters.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /delfilter <word>")
-        return
     trigger = context.args[0]
     key = sanitize_key(trigger.lower())
-    filters_data = get_filters(update.effective_chat.id)
-    removed = filters_data.pop(key, None)
-    if removed is None:
+    filter_ref = group_ref(update.effective_chat.id).child("filters").child(key)
+    if await fb_get(filter_ref) is None:
         await update.message.reply_text(f"No filter found for '{trigger}'.")
         return
-    group_ref(update.effective_chat.id).child("filters").set(filters_data)
+    await fb_delete(filter_ref)
+    update_cached_settings(update.effective_chat.id, f"filters/{key}", None)
     await update.message.reply_text(f"✅ Filter '{trigger}' removed.")
     await send_log(
         context,
@@ -381,26 +810,26 @@ async def delete_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def list_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     del context  # unused
-    filters_data = get_filters(update.effective_chat.id)
+    filters_data = await get_filters(update.effective_chat.id)
     if not filters_data:
         await update.message.reply_text("No filters configured.")
         return
     sorted_filters = sorted(
         filters_data.values(), key=lambda item: item.get("trigger", "").lower()
     )
-    lines = [f"• {item['trigger']} → {item['reply']}" for item in sorted_filters]
-    await update.message.reply_text("Current filters:\n" + "\n".join(lines))
+    text = "Current filters:\n" + "\n".join(
+        f"• {item['trigger']} → {item['reply']}" for item in sorted_filters
+    )
+    # Long filter lists exceed Telegram's message cap; send in slices.
+    for start in range(0, len(text), LOG_MESSAGE_MAX):
+        await update.message.reply_text(text[start : start + LOG_MESSAGE_MAX])
 
 
+@admin_command(usage="/setlog <chat_id>")
 async def set_log_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can set log channel.")
-        return
-    if not context.args:
-        await update.message.reply_text("Usage: /setlog <chat_id>")
-        return
     target = context.args[0]
-    group_ref(update.effective_chat.id).update({"log_channel": target})
+    await fb_update(group_ref(update.effective_chat.id), {"log_channel": target})
+    update_cached_settings(update.effective_chat.id, "log_channel", target)
     await update.message.reply_text(f"✅ Log channel set to {target}.")
     await send_log(
         context,
@@ -409,23 +838,22 @@ async def set_log_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@admin_command()
 async def unset_log_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can unset log channel.")
-        return
-    if group_ref(update.effective_chat.id).child("log_channel").get():
+    if (await get_group_settings(update.effective_chat.id)).get("log_channel"):
         await send_log(
             context,
             update.effective_chat.id,
             f"🗒️ Log channel removed by {update.effective_user.mention_html()}.",
         )
-    group_ref(update.effective_chat.id).child("log_channel").delete()
+    await fb_delete(group_ref(update.effective_chat.id).child("log_channel"))
+    update_cached_settings(update.effective_chat.id, "log_channel", None)
     await update.message.reply_text("✅ Log channel removed.")
 
 
 async def log_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     del context  # unused
-    log_chat_id = group_ref(update.effective_chat.id).child("log_channel").get()
+    log_chat_id = (await get_group_settings(update.effective_chat.id)).get("log_channel")
     if log_chat_id:
         await update.message.reply_text(f"ℹ️ Logging to chat ID: {log_chat_id}")
     else:
@@ -434,124 +862,173 @@ async def log_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 # Moderation Commands
 # -----------------------
+
+# Reused permission sets for mute/unmute; ChatPermissions is immutable, so one
+# instance per state is enough.
+MUTED_PERMISSIONS = ChatPermissions(can_send_messages=False)
+UNMUTED_PERMISSIONS = ChatPermissions(can_send_messages=True)
+
+
+@require_reply("ban")
 async def ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to /ban them.")
-        return
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can use this command.")
-        return
     target = update.message.reply_to_message.from_user
     chat_id = update.effective_chat.id
-    group_ref(chat_id).child("blacklist").child(str(target.id)).set(True)
-    try:
-        await update.effective_chat.ban_member(target.id)
-    except Exception:
-        logging.debug("Failed to ban user %s in chat %s", target.id, chat_id, exc_info=True)
-    await update.message.reply_text(f"🚫 {target.mention_html()} banned.", parse_mode="HTML")
+    # The Firebase write and the Telegram ban are independent; overlap them so
+    # the command costs max(RTT) instead of the sum.
+    fb_result, tg_result = await asyncio.gather(
+        fb_batch_update(
+            {
+                f"groups/{chat_id}/blacklist/{target.id}": True,
+                f"groups/{chat_id}/last_banned_by/{target.id}": update.effective_user.id,
+            }
+        ),
+        update.effective_chat.ban_member(target.id),
+        return_exceptions=True,
+    )
+    if isinstance(fb_result, Exception):
+        raise fb_result
+    if isinstance(tg_result, Exception):
+        LOGGER.debug("Failed to ban user %s in chat %s", target.id, chat_id, exc_info=tg_result)
+    update_cached_settings(chat_id, f"blacklist/{target.id}", True)
+    update_cached_settings(chat_id, f"last_banned_by/{target.id}", update.effective_user.id)
+    target_mention = target.mention_html()
+    actor_mention = update.effective_user.mention_html()
+    await update.message.reply_text(f"🚫 {target_mention} banned.", parse_mode="HTML")
     await send_log(
         context,
         chat_id,
-        f"🚫 {target.mention_html()} banned by {update.effective_user.mention_html()}.",
+        f"🚫 {target_mention} banned by {actor_mention}.",
     )
 
+@require_reply("unban")
 async def unban(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to /unban them.")
-        return
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can use this command.")
-        return
     target = update.message.reply_to_message.from_user
     chat_id = update.effective_chat.id
-    group_ref(chat_id).child("blacklist").child(str(target.id)).delete()
-    try:
-        await update.effective_chat.unban_member(target.id)
-    except Exception:
-        logging.debug("Failed to unban user %s in chat %s", target.id, chat_id, exc_info=True)
-    await update.message.reply_text(f"✅ {target.mention_html()} unbanned.", parse_mode="HTML")
+    fb_result, tg_result = await asyncio.gather(
+        fb_batch_update(
+            {
+                f"groups/{chat_id}/blacklist/{target.id}": None,
+                f"groups/{chat_id}/last_banned_by/{target.id}": None,
+            }
+        ),
+        update.effective_chat.unban_member(target.id),
+        return_exceptions=True,
+    )
+    if isinstance(fb_result, Exception):
+        raise fb_result
+    if isinstance(tg_result, Exception):
+        LOGGER.debug("Failed to unban user %s in chat %s", target.id, chat_id, exc_info=tg_result)
+    update_cached_settings(chat_id, f"blacklist/{target.id}", None)
+    update_cached_settings(chat_id, f"last_banned_by/{target.id}", None)
+    target_mention = target.mention_html()
+    actor_mention = update.effective_user.mention_html()
+    await update.message.reply_text(f"✅ {target_mention} unbanned.", parse_mode="HTML")
     await send_log(
         context,
         chat_id,
-        f"✅ {target.mention_html()} unbanned by {update.effective_user.mention_html()}.",
+        f"✅ {target_mention} unbanned by {actor_mention}.",
     )
 
+@require_reply("kick")
 async def kick(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to /kick them.")
-        return
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can use this command.")
-        return
     target = update.message.reply_to_message.from_user
     try:
         await update.effective_chat.ban_member(target.id)
         await update.effective_chat.unban_member(target.id)
     except Exception:
-        logging.debug("Failed to kick user %s in chat %s", target.id, update.effective_chat.id, exc_info=True)
-    await update.message.reply_text(f"👢 {target.mention_html()} kicked.", parse_mode="HTML")
+        LOGGER.debug("Failed to kick user %s in chat %s", target.id, update.effective_chat.id, exc_info=True)
+    target_mention = target.mention_html()
+    actor_mention = update.effective_user.mention_html()
+    await update.message.reply_text(f"👢 {target_mention} kicked.", parse_mode="HTML")
     await send_log(
         context,
         update.effective_chat.id,
-        f"👢 {target.mention_html()} kicked by {update.effective_user.mention_html()}.",
+        f"👢 {target_mention} kicked by {actor_mention}.",
     )
 
+@require_reply("mute")
 async def mute(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to /mute them.")
-        return
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can use this command.")
-        return
     target = update.message.reply_to_message.from_user
-    await update.effective_chat.restrict_member(target.id, permissions=ChatPermissions(can_send_messages=False))
-    await update.message.reply_text(f"🔇 {target.mention_html()} muted.", parse_mode="HTML")
+    await update.effective_chat.restrict_member(target.id, permissions=MUTED_PERMISSIONS)
+    target_mention = target.mention_html()
+    actor_mention = update.effective_user.mention_html()
+    await update.message.reply_text(f"🔇 {target_mention} muted.", parse_mode="HTML")
     await send_log(
         context,
         update.effective_chat.id,
-        f"🔇 {target.mention_html()} muted by {update.effective_user.mention_html()}.",
+        f"🔇 {target_mention} muted by {actor_mention}.",
     )
 
+@require_reply("unmute")
 async def unmute(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message.reply_to_message:
-        await update.message.reply_text("Reply to a user to /unmute them.")
-        return
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Only admins can use this command.")
-        return
     target = update.message.reply_to_message.from_user
-    await update.effective_chat.restrict_member(target.id, permissions=ChatPermissions(can_send_messages=True))
-    await update.message.reply_text(f"🔊 {target.mention_html()} unmuted.", parse_mode="HTML")
+    await update.effective_chat.restrict_member(target.id, permissions=UNMUTED_PERMISSIONS)
+    target_mention = target.mention_html()
+    actor_mention = update.effective_user.mention_html()
+    await update.message.reply_text(f"🔊 {target_mention} unmuted.", parse_mode="HTML")
     await send_log(
         context,
         update.effective_chat.id,
-        f"🔊 {target.mention_html()} unmuted by {update.effective_user.mention_html()}.",
+        f"🔊 {target_mention} unmuted by {actor_mention}.",
     )
 
 # -----------------------
 # Name History (Sangmata)
 # -----------------------
+
+# How many of the newest history entries /history fetches; push() keys are
+# chronological, so limit_to_last keeps the download O(limit) instead of
+# O(every name change ever).
+HISTORY_FETCH_LIMIT = 50
+
+# Short-lived memo of index lookups so repeated /history @name commands skip
+# the round-trip; the TTL bounds staleness after a rename.
+USERNAME_UID_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+
+
 async def track_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     del context  # unused
     user = update.effective_user
-    update_name_history(user)
+    await update_name_history(user)
 
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.args:
         username = context.args[0].lstrip("@")
-        all_users = USERS_REF.get() or {}
-        for uid, data in all_users.items():
-            if not isinstance(data, dict):
-                continue
-            hist_entries = ensure_list(data.get("history"))
-            if any(username.lower() in entry.lower() for entry in hist_entries):
+        index_key = sanitize_key(username.lower())
+        uid = USERNAME_UID_CACHE.get(index_key)
+        if uid is None:
+            uid = await fb_get(USERNAME_INDEX_REF.child(index_key))
+            if uid is not None:
+                USERNAME_UID_CACHE[index_key] = uid
+        if uid is not None:
+            hist_entries = ensure_list(
+                await fb_get(
+                    user_ref(uid).child("history").order_by_key().limit_to_last(HISTORY_FETCH_LIMIT)
+                )
+            )
+            hist = "\n".join(hist_entries) if hist_entries else "No history recorded."
+            await update.message.reply_text(f"History of {username}:\n{hist}")
+            return
+        # Fallback scan for users recorded before the index existed. A shallow
+        # get fetches only the user ids; each candidate's history is pulled
+        # individually so the scan stops at the first match instead of
+        # downloading every user's payload up front.
+        user_ids = await _run_fb(lambda: USERS_REF.get(shallow=True)) or {}
+        username_lower = username.lower()
+        for uid in user_ids:
+            hist_entries = ensure_list(await fb_get(user_ref(uid).child("history")))
+            if any(username_lower in entry.lower() for entry in hist_entries):
                 hist = "\n".join(hist_entries) if hist_entries else "No history recorded."
                 await update.message.reply_text(f"History of {username}:\n{hist}")
                 return
         await update.message.reply_text("User not found.")
     else:
         user_id = update.effective_user.id
-        hist = ensure_list(user_ref(user_id).child("history").get())
+        hist = ensure_list(
+            await fb_get(
+                user_ref(user_id).child("history").order_by_key().limit_to_last(HISTORY_FETCH_LIMIT)
+            )
+        )
         if hist:
             await update.message.reply_text("Your name history:\n" + "\n".join(hist))
         else:
@@ -560,11 +1037,64 @@ async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # -----------------------
 # Message Handler (Flood, Filters, Auto Ban)
 # -----------------------
+
+# Cap concurrent join processing so a large batch join cannot burst past
+# Telegram's messaging rate limits.
+JOIN_SEMAPHORE = asyncio.Semaphore(5)
+
+
+async def _handle_join(message, context, chat, member, welcome_on, welcome_text):
+    async with JOIN_SEMAPHORE:
+        await update_name_history(member)
+        if welcome_on:
+            await message.reply_text(format_name_vars(welcome_text, member))
+        await send_log(
+            context,
+            chat.id,
+            f"👋 {member.mention_html()} joined {html.escape(chat.title or 'the chat')}.",
+        )
+
+
+async def welcome_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    chat = update.effective_chat
+    if message is None or chat is None or not message.new_chat_members:
+        return
+    settings = await get_group_settings(chat.id)
+    welcome_on = settings.get("welcome_on")
+    welcome_text = settings.get("welcome_text") or "Welcome, {first}!"
+    await asyncio.gather(
+        *(
+            _handle_join(message, context, chat, member, welcome_on, welcome_text)
+            for member in message.new_chat_members
+        )
+    )
+
+
+async def member_left(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    chat = update.effective_chat
+    if message is None or chat is None or message.left_chat_member is None:
+        return
+    member = message.left_chat_member
+    await update_name_history(member)
+    settings = await get_group_settings(chat.id)
+    goodbye_on = settings.get("goodbye_on")
+    goodbye_text = settings.get("goodbye_text") or "Goodbye, {first}!"
+    if goodbye_on:
+        await message.reply_text(format_name_vars(goodbye_text, member))
+    await send_log(
+        context,
+        chat.id,
+        f"👋 {member.mention_html()} left {html.escape(chat.title or 'the chat')}.",
+    )
+
+
 async def check_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
 
     if message is None:
-        # Nothing to do for updates without a message payload (e.g. joins, callbacks)
+        # Nothing to do for updates without a message payload (e.g. callbacks)
         return
 
     chat = update.effective_chat
@@ -572,45 +1102,26 @@ async def check_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     chat_id = chat.id
 
-    if message.new_chat_members:
-        welcome_on = group_ref(chat_id).child("welcome_on").get()
-        welcome_text = group_ref(chat_id).child("welcome_text").get() or "Welcome, {first}!"
-        for member in message.new_chat_members:
-            update_name_history(member)
-            if welcome_on:
-                await message.reply_text(format_name_vars(welcome_text, member))
-            await send_log(
-                context,
-                chat_id,
-                f"👋 {member.mention_html()} joined {html.escape(chat.title or 'the chat')}.",
-            )
+    text = message.text or message.caption
+    if not text:
+        # The handler filter should exclude these, but guard anyway so no
+        # settings fetch or tracking runs for contentless updates.
         return
 
-    if message.left_chat_member:
-        member = message.left_chat_member
-        update_name_history(member)
-        goodbye_on = group_ref(chat_id).child("goodbye_on").get()
-        goodbye_text = group_ref(chat_id).child("goodbye_text").get() or "Goodbye, {first}!"
-        if goodbye_on:
-            await message.reply_text(format_name_vars(goodbye_text, member))
-        await send_log(
-            context,
-            chat_id,
-            f"👋 {member.mention_html()} left {html.escape(chat.title or 'the chat')}.",
-        )
-        return
+    # One snapshot per update; every branch below reads from this dict.
+    settings = await get_group_settings(chat_id)
 
     user = message.from_user
     if user is None:
         return
 
-    update_name_history(user)
+    await update_name_history(user)
 
-    if is_banned(chat_id, user.id):
+    if is_banned(settings, user.id):
         try:
             await chat.ban_member(user.id)
         except Exception:
-            logging.debug("Failed to re-ban user %s", user.id, exc_info=True)
+            LOGGER.debug("Failed to re-ban user %s", user.id, exc_info=True)
         await send_log(
             context,
             chat_id,
@@ -620,56 +1131,107 @@ async def check_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     now = time.time()
     user_key = (chat_id, user.id)
-    user_message_times[user_key].append(now)
-    user_message_times[user_key] = [t for t in user_message_times[user_key] if now - t < 10]
-    flood_limit = group_ref(chat_id).child("flood_limit").get() or 5
-    if len(user_message_times[user_key]) > flood_limit:
-        await chat.restrict_member(user.id, permissions=ChatPermissions(can_send_messages=False))
-        await message.reply_text(f"🚨 {user.mention_html()} muted for flooding.", parse_mode="HTML")
+    flood_limit = settings.get("flood_limit") or 5
+    timestamps = user_message_times.get(user_key)
+    if timestamps is None or timestamps.maxlen != flood_limit + 1:
+        # Fixed-size ring: the deque holds at most limit+1 stamps, so each
+        # message is one append and one boundary compare — no prune loop.
+        timestamps = deque(timestamps or (), maxlen=flood_limit + 1)
+    user_message_times[user_key] = timestamps
+    timestamps.append(now)
+    if len(timestamps) == timestamps.maxlen and now - timestamps[0] < FLOOD_WINDOW:
+        await chat.restrict_member(user.id, permissions=MUTED_PERMISSIONS)
+        user_mention = user.mention_html()
+        await message.reply_text(f"🚨 {user_mention} muted for flooding.", parse_mode="HTML")
         await send_log(
             context,
             chat_id,
-            f"🚨 {user.mention_html()} muted for flooding (> {flood_limit} msgs/10s).",
+            f"🚨 {user_mention} muted for flooding (> {flood_limit} msgs/10s).",
         )
-        user_message_times[user_key].clear()
+        timestamps.clear()
         return
 
-    filters_dict = get_filters(chat_id)
-    text = message.text or message.caption or ""
-    lowered = text.lower()
-    for data in filters_dict.values():
-        trigger = data.get("trigger", "")
-        reply_text = data.get("reply", "")
-        if trigger and reply_text and trigger.lower() in lowered:
+    matcher = filter_matcher_from_settings(chat_id, settings)
+    if matcher is not None:
+        reply_text = matcher(text.lower())
+        if reply_text:
             await message.reply_text(reply_text)
-            break
 
 # -----------------------
 # Main
 # -----------------------
+COMMANDS = {
+    "start": start,
+    "help": help_cmd,
+    "about": about,
+    "setwelcome": set_welcome,
+    "setgoodbye": set_goodbye,
+    "welcome": toggle_welcome,
+    "goodbye": toggle_goodbye,
+    "setflood": set_flood,
+    "addfilter": add_filter,
+    "delfilter": delete_filter,
+    "filters": list_filters,
+    "setlog": set_log_channel,
+    "unsetlog": unset_log_channel,
+    "logstatus": log_status,
+    "ban": ban,
+    "unban": unban,
+    "kick": kick,
+    "mute": mute,
+    "unmute": unmute,
+    "history": history,
+}
+
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("about", about))
-    app.add_handler(CommandHandler("setwelcome", set_welcome))
-    app.add_handler(CommandHandler("setgoodbye", set_goodbye))
-    app.add_handler(CommandHandler("welcome", toggle_welcome))
-    app.add_handler(CommandHandler("goodbye", toggle_goodbye))
-    app.add_handler(CommandHandler("setflood", set_flood))
-    app.add_handler(CommandHandler("addfilter", add_filter))
-    app.add_handler(CommandHandler("delfilter", delete_filter))
-    app.add_handler(CommandHandler("filters", list_filters))
-    app.add_handler(CommandHandler("setlog", set_log_channel))
-    app.add_handler(CommandHandler("unsetlog", unset_log_channel))
-    app.add_handler(CommandHandler("logstatus", log_status))
-    app.add_handler(CommandHandler("ban", ban))
-    app.add_handler(CommandHandler("unban", unban))
-    app.add_handler(CommandHandler("kick", kick))
-    app.add_handler(CommandHandler("mute", mute))
-    app.add_handler(CommandHandler("unmute", unmute))
-    app.add_handler(CommandHandler("history", history))
-    app.add_handler(MessageHandler(filters.ALL, check_messages))
-
-    app.run_polling()
+    if uvloop is not None:
+        uvloop.install()
+
+    start_admin_listener()
+    start_group_listener()
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(_on_startup)
+        .post_shutdown(_on_shutdown)
+        .concurrent_updates(SimpleUpdateProcessor(max_concurrent_updates=32))
+        .rate_limiter(
+            AIORateLimiter(
+                overall_max_rate=30,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+            )
+        )
+        .build()
+    )
+
+    app.add_handlers(
+        [CommandHandler(command, callback) for command, callback in COMMANDS.items()]
+        + [
+            MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_members),
+            MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, member_left),
+            MessageHandler(
+                (filters.TEXT | filters.CAPTION)
+                & ~filters.COMMAND
+                & filters.ChatType.GROUPS,
+                check_messages,
+            ),
+        ]
+    )
+
+    app.job_queue.run_repeating(_expire_flood_tracker, interval=60, first=60)
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # Telegram pushes updates to us instead of us long-polling for them.
+        # The token as URL path keeps strangers from posting fake updates.
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=BOT_TOKEN,
+            webhook_url=f"{webhook_url.rstrip('/')}/{BOT_TOKEN}",
+        )
+    else:
+        app.run_polling()